@@ -1,141 +1,352 @@
 # app.py
-import os
-import google.generativeai as genai
-import cloudinary
-import cloudinary.uploader
-from flask import Flask, request, jsonify
-from dotenv import load_dotenv
+import hashlib
+import json
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import redis
+from celery import Celery
+from celery.result import AsyncResult
+from celery.signals import task_failure
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
-load_dotenv()
+from services import (
+    GEMINI_MODEL,
+    MAX_IMAGE_BYTES,
+    PUBLIC_ID_RE,
+    REDIS_URL,
+    build_image_url,
+    generate_product_description,
+    generate_product_descriptions_batch,
+    get_cached_description,
+    image_digest,
+    is_supported_image,
+    parse_generated_text,
+    redis_client,
+    sign_upload_params,
+    store_description,
+    stream_product_description,
+    upload_and_enhance_image,
+)
+
+class ORJSONProvider(JSONProvider):
+    """Serializes jsonify() responses with orjson, which is several times faster than json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Werkzeug rejects larger bodies with a 413 before they are read into memory
+# (the extra megabyte leaves room for the form fields around the image).
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMAGE_BYTES + 1024 * 1024
 CORS(app)
 
-# --- API Keys & Configuration ---
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-cloudinary.config(
-    cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
-    api_key=os.getenv("CLOUDINARY_API_KEY"),
-    api_secret=os.getenv("CLOUDINARY_API_SECRET")
-)
+# --- Task Queue ---
+# Run the worker alongside gunicorn with: celery -A app.celery worker
+celery = Celery(app.import_name, broker=REDIS_URL, backend=REDIS_URL)
+
+# --- Background Tasks ---
+@celery.task
+def generate_task(product_name, keywords, image_bytes=None, image_public_id=None, job_key=None):
+    """Enhances the image and generates the product copy outside of the Flask worker.
+
+    `job_key` is the request's entry in the job cache, forgotten if the job fails.
+    """
+
+    if image_public_id:
+        # Step 1 already happened: the client uploaded the image itself
+        enhanced_image_url = build_image_url(image_public_id)
+        generated_text = generate_product_description(product_name, keywords)
+    else:
+        # Steps 1 & 2: Enhance Image and Generate Text (independent, so run them concurrently)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            image_future = executor.submit(upload_and_enhance_image, image_bytes)
+            text_future = executor.submit(generate_product_description, product_name, keywords)
+            enhanced_image_url = image_future.result()
+            generated_text = text_future.result()
+
+    if not enhanced_image_url or not generated_text:
+        # Let the next identical request start a fresh job instead of getting this one back
+        forget_job(job_key)
+        if not enhanced_image_url:
+            return {"error": "Failed to process image"}
+        return {"error": "Failed to generate content"}
+
+    # Step 3: Return combined response
+    return {
+        "enhanced_image_url": enhanced_image_url,
+        "generated_text": generated_text
+    }
 
-# --- Helper Functions ---
-# --- Helper Functions ---
-def generate_product_description(product_name, keywords):
-    """Generates product description, social media post, and hashtags using the Gemini API."""
+@task_failure.connect(sender=generate_task)
+def forget_failed_job(kwargs=None, **extra):
+    """Forgets the job cache entry of a job that raised instead of returning an error."""
+    forget_job((kwargs or {}).get("job_key"))
 
-    model = genai.GenerativeModel('gemini-2.5-pro')
+@celery.task(queue='batch')
+def generate_bulk_task(items):
+    """Generates product copy for a whole catalog through the (half-price) Gemini Batch API."""
 
-    prompt = f"""
-I will provide you with a product name and keywords. Your response MUST be formatted with '---' as the only delimiter between each section.
+    results = generate_product_descriptions_batch(items)
+    if results is None:
+        return {"error": "Failed to generate content"}
 
-You are an expert copywriter for a local artisan marketplace. Your task is to write a compelling, SEO-optimized product description, a short social media post, and a list of hashtags for a handmade product.
+    return {
+        "results": [
+            {"product_name": product_name, "keywords": keywords, "generated_text": generated_text}
+            for (product_name, keywords), generated_text in zip(items, results)
+        ]
+    }
 
-Product Name: {product_name}
-Keywords/Details: {keywords}
+# --- Input Validation ---
+MIN_PRODUCT_NAME_LENGTH = 2
+MAX_PRODUCT_NAME_LENGTH = 200
+MAX_KEYWORDS_LENGTH = 2000
 
----
-**Product Description:**
-Write a detailed and engaging description of the product. Highlight its unique qualities, the materials used, and the story behind it.
+def validate_product_fields(product_name, keywords):
+    """Returns an error message for inputs not worth an upstream call, or None if they are fine."""
+    if not isinstance(product_name, str) or not isinstance(keywords, str):
+        return "product_name and keywords must be strings"
+    if not MIN_PRODUCT_NAME_LENGTH <= len(product_name.strip()) <= MAX_PRODUCT_NAME_LENGTH:
+        return f"product_name must be {MIN_PRODUCT_NAME_LENGTH}-{MAX_PRODUCT_NAME_LENGTH} characters"
+    if not keywords.strip():
+        return "keywords must not be empty"
+    if len(keywords) > MAX_KEYWORDS_LENGTH:
+        return f"keywords must be at most {MAX_KEYWORDS_LENGTH} characters"
+    return None
 
----
-**Social Media Post:**
-Write a short, catchy post for Instagram or Facebook that encourages engagement.
+# --- HTTP Caching ---
+# Well inside Celery's default one-day result expiry, so a cached job ID can still be polled
+RESPONSE_MAX_AGE = 3600  # seconds
+JOB_CACHE_PREFIX = "job:v1:"
 
----
-**Hashtags:**
-Generate 5-10 relevant and popular hashtags.
-"""
+def generation_key(image_key, product_name, keywords):
+    """Identifies a generation request; the output is deterministic per input and model."""
+    return hashlib.sha256(f"{GEMINI_MODEL}|{image_key}|{product_name}|{keywords}".encode()).hexdigest()
 
+def forget_job(job_key):
+    """Drops the job remembered for a request, so the next identical request starts a new one."""
+    if job_key is None:
+        return
     try:
-        response = model.generate_content(prompt)
-
-        if not hasattr(response, 'text') or not response.text:
-            print("Gemini API returned an empty or invalid response.")
-            return None
-
-        full_text = response.text.strip()
-
-        # Split the text into parts based on "---"
-        parts = full_text.split('---')
-
-        # Initialize defaults
-        description_text = "Could not generate a full description."
-        social_post_text = "Could not generate a social media post."
-        hashtags_list = []
-
-        # Attempt to parse each section safely
-        if len(parts) > 0:
-            for part in parts:
-                if "**Product Description:**" in part:
-                    description_text = part.replace('**Product Description:**', '').strip()
-                elif "**Social Media Post:**" in part:
-                    social_post_text = part.replace('**Social Media Post:**', '').strip()
-                elif "**Hashtags:**" in part: # Changed from "**Hashtags:**:" to "**Hashtags:**"
-                    hashtags_list = part.replace('**Hashtags:**', '').strip().split() # Removed colon from replace
-
-        if not hashtags_list and "Hashtags:" in full_text:
-            # Fallback if the split didn't catch hashtags (e.g., if it was the only part after last ---)
-            hashtag_line = full_text.split("Hashtags:")[-1].strip()
-            if hashtag_line:
-                hashtags_list = hashtag_line.split()
-
-        if not description_text and "Product Description:" in full_text:
-             description_text = full_text.split("Product Description:")[-1].split("Social Media Post:")[0].strip() if "Social Media Post:" in full_text else full_text.split("Product Description:")[-1].strip()
-
-        if not social_post_text and "Social Media Post:" in full_text:
-            social_post_text = full_text.split("Social Media Post:")[-1].split("Hashtags:")[0].strip() if "Hashtags:" in full_text else full_text.split("Social Media Post:")[-1].strip()
-
-        return {
-            "description": description_text,
-            "social_post": social_post_text,
-            "hashtags": hashtags_list
-        }
-    except Exception as e:
-        print(f"Error calling Gemini API: {e}")
-        return None
+        redis_client.delete(JOB_CACHE_PREFIX + job_key)
+    except redis.RedisError as e:
+        print(f"Error writing job cache: {e}")
+
+def deduplicated_job_response(job_key, **task_kwargs):
+    """Answers with the job already started for these inputs, or enqueues a new one.
 
-def upload_and_enhance_image(image_file):
-    """Uploads an image to Cloudinary and applies an 'improve' effect."""
+    Repeats within RESPONSE_MAX_AGE get the same job_id back instead of paying for another
+    upload and Gemini call; jobs that end in an error are forgotten right away.
+    """
+    job_id = str(uuid.uuid4())
+    claimed = False
     try:
-        upload_result = cloudinary.uploader.upload(
-            image_file,
-            folder="artisan-assistant",
-            quality="auto",
-            effect="improve"
-        )
-        return upload_result['secure_url']
+        # Claim the key before enqueueing, so concurrent repeats can't start a second job
+        claimed = redis_client.set(JOB_CACHE_PREFIX + job_key, job_id, nx=True, ex=RESPONSE_MAX_AGE)
+        if not claimed:
+            existing_job_id = redis_client.get(JOB_CACHE_PREFIX + job_key)
+            if existing_job_id is not None:
+                return jsonify({"job_id": existing_job_id.decode()}), 202
+    except redis.RedisError as e:
+        print(f"Error reading job cache: {e}")
+
+    try:
+        generate_task.apply_async(kwargs={**task_kwargs, "job_key": job_key}, task_id=job_id)
     except Exception as e:
-        print(f"Error uploading image to Cloudinary: {e}")
-        return None
+        # Otherwise repeats would get back a job that was never queued
+        if claimed:
+            forget_job(job_key)
+        print(f"Error queueing generation job: {e}")
+        return jsonify({"error": "Failed to queue the job, please try again"}), 503
+    return jsonify({"job_id": job_id}), 202
 
 # --- Main API Endpoint ---
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({"error": "Image file is too large"}), 413
+
+@app.route('/api/sign-upload', methods=['POST'])
+def sign_upload():
+    """Signs a direct browser-to-Cloudinary upload, so the image never passes through Flask."""
+    return jsonify(sign_upload_params()), 200
+
 @app.route('/api/generate', methods=['POST'])
 def generate_content():
+    # Clients that uploaded via /api/sign-upload send JSON, everyone else a multipart form
+    payload = request.get_json(silent=True)
+    fields = payload if isinstance(payload, dict) else request.form
+
+    product_name = fields.get('product_name', 'Handmade Product')
+    keywords = fields.get('keywords', 'unique, eco-friendly, made with love')
+    image_public_id = fields.get('image_public_id')
+
+    # Reject bad input before it costs a Cloudinary upload or a Gemini call
+    error = validate_product_fields(product_name, keywords)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if image_public_id:
+        if not isinstance(image_public_id, str) or not PUBLIC_ID_RE.fullmatch(image_public_id):
+            return jsonify({"error": "Invalid image_public_id"}), 400
+
+        return deduplicated_job_response(
+            generation_key(image_public_id, product_name, keywords),
+            product_name=product_name,
+            keywords=keywords,
+            image_public_id=image_public_id
+        )
+
     if 'image' not in request.files:
         return jsonify({"error": "No image file provided"}), 400
 
     image_file = request.files['image']
-    product_name = request.form.get('product_name', 'Handmade Product')
-    keywords = request.form.get('keywords', 'unique, eco-friendly, made with love')
+    if not image_file.mimetype.startswith("image/"):
+        return jsonify({"error": "Image must be a JPEG, PNG, or WebP file"}), 400
 
-    # Step 1: Enhance Image
-    enhanced_image_url = upload_and_enhance_image(image_file)
-    if not enhanced_image_url:
-        return jsonify({"error": "Failed to process image"}), 500
+    # Check the file signature before reading the rest of the upload
+    header = image_file.stream.read(12)
+    image_file.stream.seek(0)
+    if not is_supported_image(header):
+        return jsonify({"error": "Image must be a JPEG, PNG, or WebP file"}), 400
 
-    # Step 2: Generate Text
-    generated_text = generate_product_description(product_name, keywords)
-    if not generated_text:
-        return jsonify({"error": "Failed to generate content"}), 500
+    # The upload stream is only valid for this request, so hand the worker the raw bytes.
+    image_bytes = image_file.read()
+    if len(image_bytes) > MAX_IMAGE_BYTES:
+        return jsonify({"error": "Image file is too large"}), 413
 
-    # Step 3: Return combined response
-    response_data = {
-        "enhanced_image_url": enhanced_image_url,
-        "generated_text": generated_text
-    }
-    return jsonify(response_data), 200
+    return deduplicated_job_response(
+        generation_key(image_digest(image_bytes), product_name, keywords),
+        product_name=product_name,
+        keywords=keywords,
+        image_bytes=image_bytes
+    )
+
+# Matches a (possibly still incomplete) string field in the JSON Gemini is streaming.
+# Compiled once; each chunk is a single finditer pass over the text received so far.
+STREAM_FIELD_RE = re.compile(r'"(description|social_post)"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+def _stream_field_deltas(full_text, sent):
+    """Yields (field, new_text) for the text fields that grew since the previous chunk.
+
+    `sent` maps each field to the text already sent and is updated in place.
+    """
+    for match in STREAM_FIELD_RE.finditer(full_text):
+        field, raw = match.groups()
+        try:
+            text = json.loads(f'"{raw}"', strict=False)
+        except ValueError:
+            # The chunk ended inside an escape sequence; the next chunk completes it
+            continue
+        if text and '\ud800' <= text[-1] <= '\udbff':
+            # The chunk ended between the halves of an escaped surrogate pair; the decoder
+            # joins them into one character once the low half arrives
+            text = text[:-1]
+        previous = sent.get(field, "")
+        if len(text) > len(previous):
+            sent[field] = text
+            yield field, text[len(previous):]
+
+def _sse(data):
+    return f"data: {app.json.dumps(data)}\n\n"
+
+@app.route('/api/generate/stream', methods=['POST'])
+def generate_content_stream():
+    """Streams the generated copy as Server-Sent Events while Gemini writes it.
+
+    Runs in the web worker rather than Celery, so it relies on the gevent worker class to keep
+    other requests moving. Images must have been uploaded directly via /api/sign-upload.
+    """
+    payload = request.get_json(silent=True)
+    fields = payload if isinstance(payload, dict) else request.form
+
+    product_name = fields.get('product_name', 'Handmade Product')
+    keywords = fields.get('keywords', 'unique, eco-friendly, made with love')
+    image_public_id = fields.get('image_public_id')
+
+    error = validate_product_fields(product_name, keywords)
+    if error:
+        return jsonify({"error": error}), 400
+    if image_public_id and (not isinstance(image_public_id, str) or not PUBLIC_ID_RE.fullmatch(image_public_id)):
+        return jsonify({"error": "Invalid image_public_id"}), 400
+
+    def events():
+        if image_public_id:
+            yield _sse({"enhanced_image_url": build_image_url(image_public_id)})
+
+        generated_text = get_cached_description(product_name, keywords)
+        if generated_text is None:
+            full_text = ""
+            sent = {}
+            try:
+                for chunk in stream_product_description(product_name, keywords):
+                    full_text += chunk
+                    for field, text in _stream_field_deltas(full_text, sent):
+                        yield _sse({"field": field, "text": text})
+            except Exception as e:
+                print(f"Error calling Gemini API: {e}")
+
+            generated_text = parse_generated_text(full_text) if full_text else None
+            if not generated_text:
+                yield _sse({"error": "Failed to generate content"})
+                return
+            store_description(product_name, keywords, generated_text)
+
+        yield _sse({"generated_text": generated_text})
+
+    # X-Accel-Buffering stops nginx-style proxies from holding the events back
+    return Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/api/generate/bulk', methods=['POST'])
+def generate_bulk_content():
+    payload = request.get_json(silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return jsonify({"error": "No items provided"}), 400
+
+    pairs = [
+        (
+            item.get('product_name', 'Handmade Product'),
+            item.get('keywords', 'unique, eco-friendly, made with love')
+        )
+        for item in items
+    ]
+    for index, (product_name, keywords) in enumerate(pairs):
+        error = validate_product_fields(product_name, keywords)
+        if error:
+            return jsonify({"error": f"Item {index}: {error}"}), 400
+
+    task = generate_bulk_task.delay(pairs)
+    return jsonify({"job_id": task.id}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    result = AsyncResult(job_id, app=celery)
+
+    response_data = {"job_id": job_id, "state": result.state}
+    if result.successful():
+        # Either the combined response or an {"error": ...} from the task
+        response_data.update(result.result)
+    elif result.failed():
+        response_data["error"] = "Job failed"
+
+    response = jsonify(response_data)
+    if result.successful() and "error" not in response_data:
+        # A finished job never changes, so its ID is a valid strong ETag and the browser can keep it
+        response.set_etag(job_id)
+        response.headers["Cache-Control"] = f"private, max-age={RESPONSE_MAX_AGE}"
+        response.make_conditional(request)
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,54 @@
+# services/__init__.py
+"""Gemini and Cloudinary helpers shared by the Flask app and the Celery workers.
+
+Configuration happens once, when this package is first imported.
+"""
+from dotenv import load_dotenv
+
+# Must run before the submodules read their settings from the environment
+load_dotenv()
+
+from services.store import REDIS_URL, redis_client
+from services.gemini import (
+    GEMINI_MODEL,
+    ProductCopy,
+    build_product_prompt,
+    generate_product_description,
+    generate_product_descriptions_batch,
+    get_cached_description,
+    parse_generated_text,
+    store_description,
+    stream_product_description,
+)
+from services.images import (
+    CLOUDINARY_FOLDER,
+    MAX_IMAGE_BYTES,
+    PUBLIC_ID_RE,
+    build_image_url,
+    image_digest,
+    is_supported_image,
+    sign_upload_params,
+    upload_and_enhance_image,
+)
+
+__all__ = [
+    "REDIS_URL",
+    "redis_client",
+    "GEMINI_MODEL",
+    "ProductCopy",
+    "build_product_prompt",
+    "generate_product_description",
+    "generate_product_descriptions_batch",
+    "get_cached_description",
+    "parse_generated_text",
+    "store_description",
+    "stream_product_description",
+    "CLOUDINARY_FOLDER",
+    "MAX_IMAGE_BYTES",
+    "PUBLIC_ID_RE",
+    "build_image_url",
+    "image_digest",
+    "is_supported_image",
+    "sign_upload_params",
+    "upload_and_enhance_image",
+]
@@ -0,0 +1,51 @@
+# services/breaker.py
+"""A minimal circuit breaker for the Gemini and Cloudinary calls."""
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fails fast after `fail_max` consecutive failures, for `reset_timeout` seconds.
+
+    Callers check `is_open()` before calling upstream and report the outcome with
+    `record_success()` / `record_failure(e)`. The lock only guards the counters, never the
+    call itself, so concurrent calls (and their retry backoff) still overlap.
+    """
+
+    def __init__(self, name, fail_max=5, reset_timeout=30, is_failure=lambda e: True):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._is_failure = is_failure
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """Returns True while calls should be skipped.
+
+        Once `reset_timeout` has passed, calls go through again; since the failure count is
+        kept until a success, the first failure after that re-opens the breaker.
+        """
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self, e):
+        """Counts the error against upstream's health, unless `is_failure` says it's the caller's fault."""
+        if not self._is_failure(e):
+            # Upstream answered; a rejected request says nothing about its health
+            self.record_success()
+            return
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.fail_max:
+                self._opened_at = time.monotonic()
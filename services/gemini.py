@@ -0,0 +1,412 @@
+# services/gemini.py
+"""Product copy generation with the Gemini API, plus the Redis cache in front of it."""
+import os
+import functools
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import google.generativeai as genai
+from google.genai import Client as GenAIClient
+from google.genai import types as genai_types
+import numpy as np
+import redis
+from google.api_core import exceptions as google_exceptions
+from pydantic import BaseModel, ValidationError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+from services.breaker import CircuitBreaker, CircuitOpenError
+from services.store import redis_client
+
+# --- API Keys & Configuration ---
+# Use the REST transport: gevent (see Procfile) patches the sockets it runs on, whereas
+# gRPC's own I/O loop would block every other request on the worker.
+genai.configure(api_key=os.getenv("GEMINI_API_KEY"), transport="rest")
+# Flash is plenty for marketing copy; set GEMINI_MODEL=gemini-2.5-pro to compare against Pro.
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+
+# --- Retries & Circuit Breaker ---
+# Rate limits and server-side failures are worth retrying; anything else is a bad request.
+RETRYABLE_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+# After 5 consecutive upstream failures, fail fast for 30s instead of queueing behind timeouts.
+# Only the retryable errors count: a rejected prompt says nothing about Gemini's health.
+gemini_breaker = CircuitBreaker(
+    "gemini",
+    fail_max=5,
+    reset_timeout=30,
+    is_failure=lambda e: isinstance(e, RETRYABLE_GEMINI_ERRORS)
+)
+
+def _gemini_unavailable():
+    return gemini_breaker.is_open()
+
+def _call_gemini(prompt, stream=False):
+    """Calls Gemini (with retries) and reports the outcome to the circuit breaker."""
+    try:
+        response = _generate_content(prompt, stream=stream)
+    except Exception as e:
+        gemini_breaker.record_failure(e)
+        raise
+    gemini_breaker.record_success()
+    return response
+
+# --- Description Cache ---
+DESCRIPTION_CACHE_PREFIX = "description:v3:"
+DESCRIPTION_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+# Embeddings are scoped per model so a near match never serves another model's copy
+SEMANTIC_CACHE_KEY = f"{DESCRIPTION_CACHE_PREFIX}embeddings:{GEMINI_MODEL}"
+# Sorted set of digest -> write time, used to expire and cap the embeddings hash
+SEMANTIC_CACHE_INDEX = SEMANTIC_CACHE_KEY + ":index"
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Per-process copy of the embeddings (digest -> (written_at, vector)), so a cache miss only
+# fetches the entries written since the last sync instead of the whole hash.
+_semantic_vectors = {}
+_semantic_synced_until = 0.0
+_semantic_lock = threading.Lock()
+
+def _embed_product(product_name, keywords):
+    """Returns a unit-length embedding of the product name and keywords, or None on failure."""
+    if _gemini_unavailable():
+        return None
+
+    try:
+        result = genai.embed_content(
+            model=EMBEDDING_MODEL,
+            content=f"{product_name}\n{keywords}",
+            task_type="semantic_similarity"
+        )
+    except Exception as e:
+        print(f"Error calling Gemini embedding API: {e}")
+        return None
+
+    vector = np.asarray(result['embedding'], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def _forget_embeddings(digests):
+    """Removes embeddings from Redis and from this process's copy."""
+    redis_client.pipeline().hdel(SEMANTIC_CACHE_KEY, *digests).zrem(SEMANTIC_CACHE_INDEX, *digests).execute()
+    with _semantic_lock:
+        for digest in digests:
+            _semantic_vectors.pop(digest, None)
+
+def _prune_embeddings(now):
+    """Drops embeddings older than the descriptions they point to, and the oldest beyond the cap."""
+    expired = redis_client.zrangebyscore(SEMANTIC_CACHE_INDEX, "-inf", now - DESCRIPTION_CACHE_TTL)
+    overflow = redis_client.zrange(SEMANTIC_CACHE_INDEX, 0, -(SEMANTIC_CACHE_MAX_ENTRIES + 1))
+    stale = set(expired) | set(overflow)
+    if stale:
+        _forget_embeddings(list(stale))
+
+def _sync_embeddings():
+    """Fetches the embeddings written since the last sync and drops expired ones locally."""
+    global _semantic_synced_until
+
+    new_entries = redis_client.zrangebyscore(SEMANTIC_CACHE_INDEX, _semantic_synced_until, "+inf", withscores=True)
+    vectors = redis_client.hmget(SEMANTIC_CACHE_KEY, [digest for digest, _ in new_entries]) if new_entries else []
+
+    cutoff = time.time() - DESCRIPTION_CACHE_TTL
+    with _semantic_lock:
+        for (digest, written_at), vector in zip(new_entries, vectors):
+            if vector is not None:
+                _semantic_vectors[digest] = (written_at, np.frombuffer(vector, dtype=np.float32))
+            _semantic_synced_until = max(_semantic_synced_until, written_at)
+
+        entries = sorted(_semantic_vectors.items(), key=lambda entry: entry[1][0])
+        expired = [digest for digest, (written_at, _) in entries if written_at < cutoff]
+        overflow = [digest for digest, _ in entries[:max(len(entries) - SEMANTIC_CACHE_MAX_ENTRIES, 0)]]
+        for digest in set(expired) | set(overflow):
+            del _semantic_vectors[digest]
+
+        return list(_semantic_vectors.items())
+
+def _find_similar_description(vector):
+    """Returns the cached description closest to the given embedding, if it is similar enough."""
+    entries = _sync_embeddings()
+    if not entries:
+        return None
+
+    matrix = np.stack([entry_vector for _, (_, entry_vector) in entries])
+    similarities = matrix @ vector  # cosine similarity, all vectors are unit-length
+    best = int(np.argmax(similarities))
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+
+    digest = entries[best][0]
+    cached = redis_client.get(DESCRIPTION_CACHE_PREFIX + digest.decode())
+    if cached is None:
+        # The description itself is gone (expired or evicted), so drop its embedding as well
+        _forget_embeddings([digest])
+        return None
+    return json.loads(cached)
+
+def _description_digest(product_name, keywords):
+    # The model is part of the key: switching GEMINI_MODEL must not serve the old model's copy
+    return hashlib.sha256(f"{GEMINI_MODEL}|{product_name}|{keywords}".encode()).hexdigest()
+
+def get_cached_description(product_name, keywords):
+    """Returns the description cached for exactly these inputs, or None."""
+    try:
+        cached = redis_client.get(DESCRIPTION_CACHE_PREFIX + _description_digest(product_name, keywords))
+    except redis.RedisError as e:
+        print(f"Error reading description cache: {e}")
+        return None
+    return json.loads(cached) if cached is not None else None
+
+def store_description(product_name, keywords, result, vector=None):
+    """Caches a generated description and, if given, its embedding for the semantic tier."""
+    digest = _description_digest(product_name, keywords)
+    try:
+        redis_client.setex(DESCRIPTION_CACHE_PREFIX + digest, DESCRIPTION_CACHE_TTL, json.dumps(result))
+        if vector is not None:
+            now = time.time()
+            pipeline = redis_client.pipeline()
+            pipeline.hset(SEMANTIC_CACHE_KEY, digest, vector.tobytes())
+            pipeline.zadd(SEMANTIC_CACHE_INDEX, {digest: now})
+            pipeline.execute()
+            _prune_embeddings(now)
+    except redis.RedisError as e:
+        print(f"Error writing description cache: {e}")
+
+def cache_description(func):
+    """Caches generated descriptions in Redis, by exact input first and then (optionally) by similarity."""
+
+    @functools.wraps(func)
+    def wrapper(product_name, keywords):
+        cached = get_cached_description(product_name, keywords)
+        if cached is not None:
+            return cached
+
+        vector = None
+        if SEMANTIC_CACHE_ENABLED:
+            vector = _embed_product(product_name, keywords)
+            if vector is not None:
+                try:
+                    similar = _find_similar_description(vector)
+                except redis.RedisError as e:
+                    print(f"Error reading description cache: {e}")
+                    similar = None
+                if similar is not None:
+                    return similar
+
+        result = func(product_name, keywords)
+
+        # Only successful generations are cached
+        if result:
+            store_description(product_name, keywords, result, vector)
+        return result
+
+    return wrapper
+
+# --- Prompt ---
+# 2.5 models count their thinking tokens against this cap, so it leaves headroom above the
+# few hundred tokens the copy itself needs.
+GEMINI_MAX_OUTPUT_TOKENS = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS", "2048"))
+
+# The instructions are kept identical across requests and the product details are appended
+# last, so Gemini can serve everything up to the product details from its prompt cache.
+STATIC_PROMPT = """
+You are an expert copywriter for a local artisan marketplace. Your task is to write a compelling, SEO-optimized product description, a short social media post, and a list of hashtags for a handmade product.
+
+I will provide you with a product name and keywords. Respond with a JSON object containing:
+
+- "description": A detailed and engaging description of the product. Highlight its unique qualities, the materials used, and the story behind it.
+- "social_post": A short, catchy post for Instagram or Facebook that encourages engagement.
+- "hashtags": A list of 5-10 relevant and popular hashtags.
+"""
+
+class ProductCopy(BaseModel):
+    """The structured response Gemini is asked to return."""
+    description: str
+    social_post: str
+    hashtags: list[str]
+
+SAMPLING_CONFIG = {
+    "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS,
+    "temperature": 0.7,
+    "top_p": 0.9
+}
+
+# Spelled out rather than passing ProductCopy: the SDK drops `required` when it converts a
+# Pydantic class, which would leave every field optional to Gemini.
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "description": {"type": "string"},
+        "social_post": {"type": "string"},
+        "hashtags": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["description", "social_post", "hashtags"]
+}
+
+GENERATION_CONFIG = {
+    **SAMPLING_CONFIG,
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA
+}
+
+# Built once and shared by every request; the underlying client keeps its connection alive.
+# STATIC_PROMPT is far below the explicit-cache minimum (1024 tokens on 2.5 Flash), so we rely
+# on Gemini's implicit prefix caching of the system instruction instead of CachedContent.
+MODEL = genai.GenerativeModel(GEMINI_MODEL, system_instruction=STATIC_PROMPT)
+
+def build_product_prompt(product_name, keywords):
+    """Builds the per-product part of the prompt that follows STATIC_PROMPT."""
+    return f"Product Name: {product_name}\nKeywords/Details: {keywords}"
+
+# --- Helper Functions ---
+# The model sometimes returns "#handmade," or several tags in one entry; this pulls out the
+# words, with or without their leading '#'.
+HASHTAG_RE = re.compile(r"#?(\w+)")
+
+def parse_generated_text(text):
+    """Validates Gemini's JSON response against ProductCopy and returns it as a dict."""
+    try:
+        product_copy = ProductCopy.model_validate_json(text)
+    except ValidationError as e:
+        print(f"Gemini API returned a malformed response: {e}")
+        return None
+
+    tags = HASHTAG_RE.findall(" ".join(product_copy.hashtags))
+    product_copy.hashtags = list(dict.fromkeys(f"#{tag}" for tag in tags))
+    return product_copy.model_dump()
+
+@retry(
+    retry=retry_if_exception_type(RETRYABLE_GEMINI_ERRORS),
+    wait=wait_exponential_jitter(initial=1, max=20),
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+def _generate_content(prompt, stream=False):
+    """Calls Gemini, retrying transient failures with exponential backoff and jitter."""
+    return MODEL.generate_content(prompt, generation_config=GENERATION_CONFIG, stream=stream)
+
+@cache_description
+def generate_product_description(product_name, keywords):
+    """Generates product description, social media post, and hashtags using the Gemini API.
+
+    Cached descriptions are still served while the circuit breaker is open; anything else
+    fails fast until Gemini recovers.
+    """
+
+    if _gemini_unavailable():
+        print("Gemini API circuit breaker is open, skipping the call.")
+        return None
+
+    prompt = build_product_prompt(product_name, keywords)
+
+    try:
+        response = _call_gemini(prompt)
+
+        if not hasattr(response, 'text') or not response.text:
+            print("Gemini API returned an empty or invalid response.")
+            return None
+
+        return parse_generated_text(response.text)
+    except Exception as e:
+        print(f"Error calling Gemini API: {e}")
+        return None
+
+def stream_product_description(product_name, keywords):
+    """Yields the text of Gemini's (JSON) response as it is generated.
+
+    Only opening the stream is retried; a failure mid-stream is raised to the caller, as is
+    CircuitOpenError while the circuit breaker is open.
+    """
+    if _gemini_unavailable():
+        raise CircuitOpenError("Gemini API circuit breaker is open")
+    response = _call_gemini(build_product_prompt(product_name, keywords), stream=True)
+    for chunk in response:
+        # The final chunk may only carry the finish reason
+        if chunk.parts:
+            yield chunk.text
+
+BATCH_POLL_INTERVAL = 30  # seconds
+BATCH_DONE_STATES = {
+    genai_types.JobState.JOB_STATE_SUCCEEDED,
+    genai_types.JobState.JOB_STATE_FAILED,
+    genai_types.JobState.JOB_STATE_CANCELLED,
+    genai_types.JobState.JOB_STATE_EXPIRED,
+}
+
+@functools.cache
+def _get_genai_client():
+    """Returns the google-genai client, which (unlike google.generativeai) exposes the Batch API."""
+    return GenAIClient(api_key=os.getenv("GEMINI_API_KEY"))
+
+def _batch_response_text(response):
+    """Extracts the generated text from a GenerateContentResponse in a batch output file."""
+    try:
+        parts = response['candidates'][0]['content']['parts']
+    except (KeyError, IndexError, TypeError):
+        return None
+    return "".join(part.get('text', '') for part in parts if not part.get('thought'))
+
+def generate_product_descriptions_batch(items):
+    """Generates product copy for many (product_name, keywords) pairs using the Gemini Batch API.
+
+    Batch requests are billed at half the interactive price but may take minutes to complete,
+    so this is only meant for non-interactive work. Returns one result (or None) per item, in
+    order, or None if the batch job itself failed.
+    """
+    lines = []
+    for index, (product_name, keywords) in enumerate(items):
+        lines.append(json.dumps({
+            "key": str(index),
+            "request": {
+                "system_instruction": {"parts": [{"text": STATIC_PROMPT}]},
+                "contents": [{"role": "user", "parts": [{"text": build_product_prompt(product_name, keywords)}]}],
+                "generation_config": {
+                    **SAMPLING_CONFIG,
+                    "response_mime_type": "application/json",
+                    "response_json_schema": ProductCopy.model_json_schema()
+                }
+            }
+        }))
+
+    try:
+        genai_client = _get_genai_client()
+        input_file = genai_client.files.upload(
+            file=io.BytesIO("\n".join(lines).encode()),
+            config={"display_name": "artisan-descriptions", "mime_type": "jsonl"}
+        )
+        job = genai_client.batches.create(
+            model=GEMINI_MODEL,
+            src=input_file.name,
+            config={"display_name": "artisan-descriptions"}
+        )
+        while job.state not in BATCH_DONE_STATES:
+            time.sleep(BATCH_POLL_INTERVAL)
+            job = genai_client.batches.get(name=job.name)
+
+        if job.state != genai_types.JobState.JOB_STATE_SUCCEEDED:
+            print(f"Gemini batch job {job.name} finished with state {job.state}: {job.error}")
+            return None
+
+        output = genai_client.files.download(file=job.dest.file_name)
+    except Exception as e:
+        print(f"Error calling Gemini Batch API: {e}")
+        return None
+
+    results = [None] * len(items)
+    for line in output.decode().splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        text = _batch_response_text(entry.get('response'))
+        if text:
+            results[int(entry['key'])] = parse_generated_text(text)
+        else:
+            print(f"Gemini batch request {entry.get('key')} failed: {entry.get('error')}")
+    return results
@@ -0,0 +1,155 @@
+# services/images.py
+"""Image upload and enhancement with Cloudinary."""
+import os
+import hashlib
+import io
+import re
+import time
+import cloudinary
+import cloudinary.uploader
+import cloudinary.utils
+import redis
+from cloudinary.exceptions import Error as CloudinaryError, GeneralError, RateLimited
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+from services.breaker import CircuitBreaker
+from services.store import redis_client
+
+CLOUDINARY_FOLDER = "artisan-assistant"
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 6_000_000
+
+# --- API Keys & Configuration ---
+cloudinary.config(
+    cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
+    api_key=os.getenv("CLOUDINARY_API_KEY"),
+    api_secret=os.getenv("CLOUDINARY_API_SECRET"),
+    secure=True
+)
+# The uploader keeps one module-level urllib3 pool; size it for every greenlet that may upload
+# concurrently in this process (the Celery worker's -c) so connections are reused instead of
+# discarded. `_http` is private, checked against cloudinary 1.44.1.
+CLOUDINARY_POOL_MAXSIZE = int(os.getenv("CLOUDINARY_POOL_MAXSIZE") or os.getenv("CELERY_CONCURRENCY") or "100")
+cloudinary.uploader._http = cloudinary.utils.get_http_connector(
+    cloudinary.config(),
+    {**cloudinary.CERT_KWARGS, "maxsize": CLOUDINARY_POOL_MAXSIZE}
+)
+
+# --- Retries & Circuit Breaker ---
+def _is_retryable_cloudinary_error(e):
+    # The SDK raises the bare base class for network failures and unmapped 5xx responses
+    return isinstance(e, (RateLimited, GeneralError)) or type(e) is CloudinaryError
+
+cloudinary_breaker = CircuitBreaker(
+    "cloudinary",
+    fail_max=5,
+    reset_timeout=30,
+    is_failure=_is_retryable_cloudinary_error
+)
+
+@retry(
+    retry=retry_if_exception(_is_retryable_cloudinary_error),
+    wait=wait_exponential_jitter(initial=1, max=20),
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+def _upload_large(image_data, **options):
+    """Uploads to Cloudinary, retrying transient failures with exponential backoff and jitter."""
+    return cloudinary.uploader.upload_large(io.BytesIO(image_data), chunk_size=UPLOAD_CHUNK_SIZE, **options)
+
+# --- Helper Functions ---
+def is_supported_image(header):
+    """Checks the leading bytes of an upload for a JPEG, PNG, or WebP signature."""
+    return (
+        header.startswith(b"\xff\xd8\xff")
+        or header.startswith(b"\x89PNG\r\n\x1a\n")
+        or (header[:4] == b"RIFF" and header[8:12] == b"WEBP")
+    )
+
+IMAGE_CACHE_PREFIX = "img:v2:"
+IMAGE_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+
+def image_digest(image_data):
+    """Returns a content hash of the image bytes (blake2b is fast enough to be negligible here)."""
+    return hashlib.blake2b(image_data, digest_size=16).hexdigest()
+
+def upload_and_enhance_image(image_data):
+    """Uploads an image (raw bytes) to Cloudinary in chunks and returns its enhanced URL.
+
+    Re-submissions of the same bytes (e.g. a seller iterating on keywords) reuse the earlier
+    upload instead of sending the image again.
+    """
+    digest = image_digest(image_data)
+    try:
+        cached_public_id = redis_client.get(IMAGE_CACHE_PREFIX + digest)
+        if cached_public_id is not None:
+            return build_image_url(cached_public_id.decode())
+    except redis.RedisError as e:
+        print(f"Error reading image cache: {e}")
+
+    if cloudinary_breaker.is_open():
+        print("Cloudinary circuit breaker is open, skipping the upload.")
+        return None
+
+    try:
+        # Naming the asset after its hash lets Cloudinary dedupe it too if our cache entry is gone
+        upload_result = _upload_large(
+            image_data,
+            folder=CLOUDINARY_FOLDER,
+            public_id=digest,
+            unique_filename=False,
+            overwrite=False
+        )
+    except Exception as e:
+        cloudinary_breaker.record_failure(e)
+        print(f"Error uploading image to Cloudinary: {e}")
+        return None
+    cloudinary_breaker.record_success()
+    public_id = upload_result['public_id']
+
+    try:
+        redis_client.setex(IMAGE_CACHE_PREFIX + digest, IMAGE_CACHE_TTL, public_id)
+    except redis.RedisError as e:
+        print(f"Error writing image cache: {e}")
+    return build_image_url(public_id)
+
+PUBLIC_ID_RE = re.compile(rf"{CLOUDINARY_FOLDER}/[\w\-/]+")
+
+def build_image_url(public_id):
+    """Returns the enhanced delivery URL of an uploaded image.
+
+    The 'improve' effect is applied by Cloudinary on first delivery and then served from its
+    CDN, so uploads don't wait for it; f_auto serves AVIF/WebP to browsers that support them.
+    """
+    return cloudinary.CloudinaryImage(public_id).build_url(
+        secure=True,
+        effect="improve",
+        quality="auto",
+        fetch_format="auto"
+    )
+
+UPLOAD_ALLOWED_FORMATS = "jpg,png,webp"
+# Signed params can't cap the file size, so direct uploads should go through an upload preset
+# whose max file size matches MAX_IMAGE_BYTES.
+CLOUDINARY_UPLOAD_PRESET = os.getenv("CLOUDINARY_UPLOAD_PRESET")
+
+def sign_upload_params():
+    """Returns the signed parameters a browser needs to upload directly to Cloudinary.
+
+    Every param here is covered by the signature, so the browser can't widen the formats
+    or pick another preset.
+    """
+    config = cloudinary.config()
+    params = {
+        "timestamp": int(time.time()),
+        "folder": CLOUDINARY_FOLDER,
+        "allowed_formats": UPLOAD_ALLOWED_FORMATS
+    }
+    if CLOUDINARY_UPLOAD_PRESET:
+        params["upload_preset"] = CLOUDINARY_UPLOAD_PRESET
+    return {
+        **params,
+        "signature": cloudinary.utils.api_sign_request(params, config.api_secret),
+        "api_key": config.api_key,
+        "cloud_name": config.cloud_name
+    }
@@ -0,0 +1,7 @@
+# services/store.py
+"""The Redis connection shared by the caches and the Celery broker/backend."""
+import os
+import redis
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+redis_client = redis.Redis.from_url(REDIS_URL)
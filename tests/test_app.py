@@ -0,0 +1,103 @@
+import json
+
+import fakeredis
+import pytest
+
+import app as app_module
+
+STREAMED_JSON = '{"description": "Glazed mug \\ud83c\\udffa, fired twice", "social_post": "New in \\u2615", "hashtags": ["pottery"]}'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app_module, "get_cached_description", lambda product_name, keywords: None)
+    monkeypatch.setattr(app_module, "store_description", lambda product_name, keywords, result: None)
+    return app_module.app.test_client()
+
+
+class RecordingTask:
+    """Stands in for generate_task, recording the jobs it would have queued."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.queued = []
+
+    def apply_async(self, kwargs, task_id):
+        if self.error:
+            raise self.error
+        self.queued.append(task_id)
+
+
+@pytest.fixture
+def job_cache(monkeypatch):
+    fake_redis = fakeredis.FakeRedis()
+    monkeypatch.setattr(app_module, "redis_client", fake_redis)
+    return fake_redis
+
+
+GENERATE_REQUEST = {"product_name": "Mug", "keywords": "clay", "image_public_id": "artisan-assistant/mug"}
+
+
+def _events(response):
+    return [json.loads(line[len("data: "):]) for line in response.get_data(as_text=True).splitlines() if line]
+
+
+def test_stream_splits_surrogate_pairs_cleanly(client, monkeypatch):
+    # One character per chunk puts a boundary between the halves of every escape sequence
+    monkeypatch.setattr(app_module, "stream_product_description", lambda product_name, keywords: iter(STREAMED_JSON))
+
+    response = client.post('/api/generate/stream', json={"product_name": "Mug", "keywords": "clay"})
+    events = _events(response)
+
+    streamed = {}
+    for event in events[:-1]:
+        streamed[event["field"]] = streamed.get(event["field"], "") + event["text"]
+
+    assert events[-1] == {"generated_text": {
+        "description": "Glazed mug \U0001f3fa, fired twice",
+        "social_post": "New in ☕",
+        "hashtags": ["#pottery"]
+    }}
+    assert streamed == {"description": "Glazed mug \U0001f3fa, fired twice", "social_post": "New in ☕"}
+
+
+def test_repeat_generation_returns_the_same_job(client, job_cache, monkeypatch):
+    task = RecordingTask()
+    monkeypatch.setattr(app_module, "generate_task", task)
+
+    first = client.post('/api/generate', json=GENERATE_REQUEST)
+    second = client.post('/api/generate', json=GENERATE_REQUEST)
+
+    assert first.status_code == second.status_code == 202
+    assert first.get_json()["job_id"] == second.get_json()["job_id"] == task.queued[0]
+    assert len(task.queued) == 1
+    assert "ETag" not in second.headers
+
+
+def test_errored_job_is_forgotten(client, job_cache, monkeypatch):
+    generate_task = app_module.generate_task
+    monkeypatch.setattr(app_module, "generate_task", RecordingTask())
+    monkeypatch.setattr(app_module, "build_image_url", lambda public_id: f"https://example.com/{public_id}")
+    monkeypatch.setattr(app_module, "generate_product_description", lambda product_name, keywords: None)
+
+    client.post('/api/generate', json=GENERATE_REQUEST)
+    (job_key,) = [key.decode()[len(app_module.JOB_CACHE_PREFIX):] for key in job_cache.keys()]
+
+    result = generate_task.run("Mug", "clay", image_public_id="artisan-assistant/mug", job_key=job_key)
+
+    assert result == {"error": "Failed to generate content"}
+    assert job_cache.keys() == []
+
+
+def test_failed_enqueue_releases_the_claim(client, job_cache, monkeypatch):
+    monkeypatch.setattr(app_module, "generate_task", RecordingTask(error=ConnectionError("broker down")))
+    failed = client.post('/api/generate', json=GENERATE_REQUEST)
+
+    assert failed.status_code == 503
+    assert job_cache.keys() == []
+
+    task = RecordingTask()
+    monkeypatch.setattr(app_module, "generate_task", task)
+    retried = client.post('/api/generate', json=GENERATE_REQUEST)
+
+    assert retried.get_json()["job_id"] == task.queued[0]
@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+from google.generativeai.types import generation_types
+
+from services import gemini
+from services.breaker import CircuitBreaker
+
+CALL_SECONDS = 0.5
+
+
+class SlowModel:
+    """Stands in for the Gemini model; each call takes CALL_SECONDS."""
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        time.sleep(CALL_SECONDS)
+        return type("Response", (), {"text": '{"description": "d", "social_post": "s", "hashtags": ["a"]}'})()
+
+
+@pytest.fixture
+def slow_model(monkeypatch):
+    monkeypatch.setattr(gemini, "MODEL", SlowModel())
+    monkeypatch.setattr(gemini, "gemini_breaker", CircuitBreaker("gemini-test"))
+
+
+def test_concurrent_gemini_calls_overlap(slow_model):
+    generate = gemini.generate_product_description.__wrapped__  # skip the Redis cache
+    results = []
+    threads = [
+        threading.Thread(target=lambda name=name: results.append(generate(name, "clay")))
+        for name in ("Mug", "Bowl")
+    ]
+
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    assert len(results) == 2 and all(results)
+    assert elapsed < 1.5 * CALL_SECONDS
+
+
+def test_breaker_opens_on_retryable_errors_only():
+    breaker = CircuitBreaker("test", fail_max=2, reset_timeout=30, is_failure=lambda e: isinstance(e, gemini.RETRYABLE_GEMINI_ERRORS))
+
+    breaker.record_failure(google_exceptions.InvalidArgument("bad prompt"))
+    breaker.record_failure(google_exceptions.InvalidArgument("bad prompt"))
+    assert not breaker.is_open()
+
+    breaker.record_failure(google_exceptions.ServiceUnavailable("down"))
+    breaker.record_failure(google_exceptions.ServiceUnavailable("down"))
+    assert breaker.is_open()
+
+    breaker.record_success()
+    assert not breaker.is_open()
+
+
+def test_response_schema_requires_every_field():
+    config = generation_types.to_generation_config_dict(gemini.GENERATION_CONFIG)
+
+    assert set(config["response_schema"].required) == set(gemini.ProductCopy.model_fields)